@@ -1,97 +1,367 @@
+import io
+import os
 import random
-import json
+import queue
+import shutil
 import logging
+import tarfile
+import threading
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
-from datasets import load_dataset
+
+import orjson
+from datasets import Image, load_dataset
+from datasets.distributed import split_dataset_by_node
+from PIL import Image as PILImage
+from parse_styles import STYLE_MAPPING
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s"
 )
 
+WRITE_BATCH_SIZE = 1024
+JPEG_MAGIC = b"\xff\xd8\xff"
+SHARD_WRITE_BUFFER = 8 * 1024 * 1024
+# Longest image side kept on disk; the Qwen-VL vision tower resizes to about this anyway.
+MAX_SIDE = 1024
+JPEG_QUALITY = 90
+INSTRUCTION = (
+    "Analyze this image and return JSON with fields: "
+    "watermarks, text, main object, style."
+)
+
+
+def load_wikiart():
+    """
+    Stream the WikiArt train split using Hugging Face datasets library.
+    Samples are fetched lazily, so no Arrow cache is materialized on disk.
+    Images are left undecoded: each sample holds the original JPEG bytes.
+    """
+    dataset = load_dataset("huggan/wikiart", split="train", streaming=True)
+    return dataset.cast_column("image", Image(decode=False))
+
 
-def load_wikiart(cache_dir: str = "cache"):
+def prefetch(iterable, num_prefetch_queue: int = 32):
     """
-    Load the WikiArt dataset using Hugging Face datasets library.
+    Iterate over `iterable` in a background thread through a bounded queue,
+    so fetching and decoding the next samples overlaps with consuming the current one.
     """
-    return load_dataset("huggan/wikiart", cache_dir=cache_dir)
+    q = queue.Queue(maxsize=num_prefetch_queue)
+    sentinel = object()
+    error = []
+
+    def producer():
+        try:
+            for item in iterable:
+                q.put(item)
+        except Exception as e:
+            error.append(e)
+        finally:
+            q.put(sentinel)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item = q.get()
+        if item is sentinel:
+            break
+        yield item
+
+    if error:
+        raise error[0]
 
 
-def select_balanced_subset(dataset, target_total: int = 5000):
+def style_quotas(target_total: int, shard_id: int = 0, num_shards: int = 1) -> dict:
     """
-    Select a balanced subset of the WikiArt dataset across styles.
-    Returns dataset indices.
+    Number of images each style contributes to one shard of a target_total-image subset.
+    The remainders of both divisions are spread one image at a time, rotating over shards,
+    so summing the quotas over all styles and shards gives exactly target_total.
     """
-    style_to_indices = defaultdict(list)
-    for i, sample in enumerate(dataset["train"]):
-        style = sample["style"] if sample["style"] else "unknown"
-        style_to_indices[style].append(i)
+    num_styles = len(STYLE_MAPPING)
+    quotas = {}
+    for i, style in enumerate(STYLE_MAPPING):
+        style_total = target_total // num_styles + (i < target_total % num_styles)
+        quotas[style] = style_total // num_shards + ((i + shard_id) % num_shards < style_total % num_shards)
+    return quotas
 
-    num_styles = len(style_to_indices)
-    per_style = target_total // num_styles
-    logging.info("Found %d styles, selecting ~%d images per style", num_styles, per_style)
 
-    selected_indices = []
-    for style, indices in style_to_indices.items():
-        if len(indices) <= per_style:
-            chosen = indices
+def select_balanced_subset(dataset, target_total: int = 5000, quotas: dict = None):
+    """
+    Select a balanced subset of the WikiArt dataset across styles in a single pass.
+    Keeps a per-style reservoir (Algorithm R), so the stream is never indexed.
+    quotas maps style to its number of images (defaults to style_quotas(target_total)).
+    Returns a list of (style, image, meta) tuples ready to be saved.
+    """
+    if quotas is None:
+        quotas = style_quotas(target_total)
+    target_total = sum(quotas.values())
+    logging.info("Selecting %d-%d images per style across %d styles",
+                 min(quotas.values()), max(quotas.values()), len(quotas))
+
+    reservoirs = defaultdict(list)
+    seen = defaultdict(int)
+    for sample in dataset:
+        style = sample["style"] if sample["style"] is not None else "unknown"
+        per_style = quotas.get(style, 0)
+        if not per_style:
+            continue
+        seen[style] += 1
+
+        reservoir = reservoirs[style]
+        if len(reservoir) < per_style:
+            slot = len(reservoir)
+            reservoir.append(None)
         else:
-            chosen = random.sample(indices, per_style)
-        selected_indices.extend(chosen)
+            slot = random.randrange(seen[style])
+            if slot >= per_style:
+                continue
+
+        meta = {
+            "artist": sample.get("artist", None),
+            "genre": sample.get("genre", None),
+            "style_raw": sample.get("style", None)
+        }
+        reservoir[slot] = (style, sample["image"], meta)
+
+    selected = [item for reservoir in reservoirs.values() for item in reservoir]
+    logging.info("Selected %d images in total from %d styles", len(selected), len(reservoirs))
+    if len(selected) < target_total:
+        logging.warning("Stream held too few images for some styles: %d short of %d",
+                        target_total - len(selected), target_total)
+    return selected
+
+
+def _image_bytes(image: dict, max_side: int = MAX_SIDE) -> bytes:
+    """
+    Return JPEG bytes of an undecoded dataset image, at most max_side pixels on its longer side.
+    JPEGs that already fit are passed through untouched; anything else is downscaled and re-encoded.
+    """
+    data = image["bytes"]
+    if data is None:
+        with open(image["path"], "rb") as src:
+            data = src.read()
+
+    img = PILImage.open(io.BytesIO(data))
+    fits = max_side is None or max(img.size) <= max_side
+    if fits and data.startswith(JPEG_MAGIC):
+        return data
+
+    if not fits:
+        img.draft("RGB", (max_side, max_side))
+    img = img.convert("RGB")
+    if not fits:
+        img.thumbnail((max_side, max_side), PILImage.Resampling.LANCZOS)
+
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=False, progressive=False, subsampling=2)
+    return buf.getvalue()
+
 
-    selected_indices = selected_indices[:target_total]
-    logging.info("Selected %d images in total", len(selected_indices))
-    return selected_indices
+def _write_manifest(out_path: Path, max_side: int):
+    """
+    Record the stored image resolution and JPEG quality next to the dataset.
+    """
+    manifest = {"max_side": max_side, "jpeg_quality": JPEG_QUALITY}
+    with open(out_path / "manifest.json", "wb") as f:
+        f.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+
+
+def _build_entry(img_path: str, style, meta: dict) -> dict:
+    """
+    Build the JSONL annotation record for a saved image.
+    """
+    return {
+        "image_path": img_path,
+        "instruction": INSTRUCTION,
+        "output": {
+            "watermarks": 0,
+            "text": "",
+            "main object": "painting",
+            "style": style
+        },
+        "meta": meta
+    }
+
+
+def _write_image(image: dict, img_path: Path, max_side: int = MAX_SIDE) -> Path:
+    """
+    Write the _image_bytes output to disk: the original JPEG bytes, or a downscaled re-encode.
+    """
+    with open(img_path, "wb") as dst:
+        dst.write(_image_bytes(image, max_side))
+    return img_path
+
+
+def _write_completed(done, pending: dict, buf: list) -> int:
+    """
+    Encode JSONL entries for finished save futures into `buf`, skipping failed ones.
+    Returns the number of entries added.
+    """
+    written = 0
+    for future in done:
+        entry = pending.pop(future)
+        try:
+            future.result()
+        except Exception as e:
+            logging.error("Saving failed for %s: %s", entry["image_path"], e)
+            continue
+        buf.append(orjson.dumps(entry) + b"\n")
+        written += 1
+    return written
 
 
-def save_subset(dataset, selected_indices, out_dir: str = "wikiart_5k", out_json: str = "wikiart_5k.jsonl"):
+def save_subset(selected, out_dir: str = "wikiart_5k", out_json: str = "wikiart_5k.jsonl",
+                max_workers: int = None, first_id: int = 0, id_step: int = 1,
+                max_side: int = MAX_SIDE, write_manifest: bool = True) -> int:
     """
     Save selected subset of WikiArt images to disk and write JSONL annotations.
+    File writes run in a thread pool; an annotation is written only once its image is saved.
+    Image ids are first_id, first_id + id_step, ... so parallel shards never collide.
+    Images are limited to max_side pixels on their longer side (None keeps full resolution).
+    With write_manifest unset the caller is responsible for out_dir/manifest.json.
+    Returns the number of images saved.
     """
     out_path = Path(out_dir)
     out_path.mkdir(parents=True, exist_ok=True)
+    if write_manifest:
+        _write_manifest(out_path, max_side)
+    max_workers = max_workers or os.cpu_count() or 1
 
-    with open(out_json, "w", encoding="utf-8") as f:
-        for new_id, idx in enumerate(selected_indices):
-            sample = dataset["train"][idx]
-            img = sample["image"]
-
-            img_path = out_path / f"wikiart_{new_id:05d}.jpg"
-            img.save(img_path, format="JPEG", quality=95)
-
-            entry = {
-                "image_path": str(img_path),
-                "instruction": (
-                    "Analyze this image and return JSON with fields: "
-                    "watermarks, text, main object, style."
-                ),
-                "output": {
-                    "watermarks": 0,
-                    "text": "",
-                    "main object": "painting",
-                    "style": sample["style"] if sample["style"] else "unknown"
-                },
-                "meta": {
-                    "artist": sample.get("artist", None),
-                    "genre": sample.get("genre", None),
-                    "style_raw": sample.get("style", None)
-                }
-            }
-
-            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    saved = 0
+    pending = {}
+    buf = []
+    with open(out_json, "wb") as f, ThreadPoolExecutor(max_workers=max_workers) as ex:
+        for new_id, (style, image, meta) in enumerate(selected):
+            img_path = out_path / f"wikiart_{first_id + new_id * id_step:05d}.jpg"
+            entry = _build_entry(str(img_path), style, meta)
+            pending[ex.submit(_write_image, image, img_path, max_side)] = entry
 
-            if new_id % 500 == 0 and new_id > 0:
-                logging.info("Saved %d / %d images", new_id, len(selected_indices))
+            if len(pending) >= 2 * max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                before = saved
+                saved += _write_completed(done, pending, buf)
+                if saved // 500 > before // 500:
+                    logging.info("Saved %d / %d images", saved, len(selected))
+                if len(buf) >= WRITE_BATCH_SIZE:
+                    f.writelines(buf)
+                    buf.clear()
+
+        saved += _write_completed(wait(pending).done, pending, buf)
+        f.writelines(buf)
 
     logging.info("Finished: %d images saved to %s, metadata in %s",
-                 len(selected_indices), out_path, out_json)
+                 saved, out_path, out_json)
+    return saved
+
+
+def _dump_shard(shard_id: int, num_shards: int, target_total: int, out_dir: str, out_json: str,
+                max_side: int = MAX_SIDE) -> int:
+    """
+    Worker entry point: stream one shard of WikiArt, sample it and save it.
+    """
+    dataset = split_dataset_by_node(load_wikiart(), rank=shard_id, world_size=num_shards)
+    quotas = style_quotas(target_total, shard_id, num_shards)
+    selected = select_balanced_subset(prefetch(dataset), quotas=quotas)
+    return save_subset(
+        selected, out_dir=out_dir, out_json=out_json,
+        max_workers=max(1, (os.cpu_count() or 1) // num_shards),
+        first_id=shard_id, id_step=num_shards, max_side=max_side, write_manifest=False
+    )
+
+
+def dump_parallel(target_total: int = 5000, out_dir: str = "wikiart_5k", out_json: str = "wikiart_5k.jsonl",
+                  num_shards: int = None, max_side: int = MAX_SIDE):
+    """
+    Split the WikiArt stream into shards and dump each one in its own process.
+    Per-shard JSONL files are concatenated into out_json at the end.
+    """
+    num_shards = num_shards or min(os.cpu_count() or 1, 8)
+    part_paths = [f"{out_json}.part{shard_id:02d}" for shard_id in range(num_shards)]
+    out_path = Path(out_dir)
+    out_path.mkdir(parents=True, exist_ok=True)
+    _write_manifest(out_path, max_side)
+
+    with ProcessPoolExecutor(max_workers=num_shards) as ex:
+        futures = [
+            ex.submit(_dump_shard, shard_id, num_shards, target_total, out_dir, part_paths[shard_id], max_side)
+            for shard_id in range(num_shards)
+        ]
+        saved = sum(future.result() for future in futures)
+
+    with open(out_json, "wb") as out_f:
+        for part_path in part_paths:
+            with open(part_path, "rb") as part_f:
+                shutil.copyfileobj(part_f, out_f)
+            os.remove(part_path)
+
+    logging.info("Finished: %d images saved by %d workers, metadata in %s", saved, num_shards, out_json)
+    if saved < target_total:
+        logging.warning("Dumped %d images, %d short of the %d requested", saved, target_total - saved, target_total)
+
+
+def _add_tar_member(tar: tarfile.TarFile, name: str, data: bytes):
+    """
+    Append an in-memory file to an open tar archive.
+    """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _open_shard(path: Path) -> tarfile.TarFile:
+    """
+    Open a tar shard for writing on top of a large write buffer, so members
+    reach the kernel as a few big sequential writes instead of many small ones.
+    """
+    return tarfile.open(fileobj=open(path, "wb", buffering=SHARD_WRITE_BUFFER), mode="w")
+
+
+def _close_shard(tar: tarfile.TarFile):
+    """
+    Finalize a tar shard and close its underlying file.
+    """
+    tar.close()
+    tar.fileobj.close()
+
+
+def save_subset_shards(selected, out_dir: str = "wikiart_5k_shards", maxcount: int = 10000,
+                       max_side: int = MAX_SIDE):
+    """
+    Save selected subset as WebDataset-compatible tar shards instead of one file per image.
+    Each sample is stored as <key>.jpg plus <key>.json with its annotation.
+    """
+    out_path = Path(out_dir)
+    out_path.mkdir(parents=True, exist_ok=True)
+    _write_manifest(out_path, max_side)
+
+    tar = None
+    num_shards = 0
+    try:
+        for new_id, (style, image, meta) in enumerate(selected):
+            if new_id % maxcount == 0:
+                if tar is not None:
+                    _close_shard(tar)
+                tar = _open_shard(out_path / f"wikiart-{num_shards:06d}.tar")
+                num_shards += 1
+
+            key = f"wikiart_{new_id:05d}"
+            entry = _build_entry(f"{key}.jpg", style, meta)
+            _add_tar_member(tar, f"{key}.jpg", _image_bytes(image, max_side))
+            _add_tar_member(tar, f"{key}.json", orjson.dumps(entry))
+
+            if new_id % 500 == 0 and new_id > 0:
+                logging.info("Saved %d / %d images", new_id, len(selected))
+    finally:
+        if tar is not None:
+            _close_shard(tar)
+
+    logging.info("Finished: %d images saved to %d shards in %s",
+                 len(selected), num_shards, out_path)
 
 
 def main():
-    dataset = load_wikiart()
-    selected_indices = select_balanced_subset(dataset, target_total=5000)
-    save_subset(dataset, selected_indices)
+    dump_parallel(target_total=5000)
 
 
 if __name__ == "__main__":
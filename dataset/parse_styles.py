@@ -1,6 +1,12 @@
 import os
-import json
+import mmap
+import pickle
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import orjson
 
 STYLE_MAPPING = {
     0: "Abstract_Expressionism",
@@ -31,26 +37,80 @@ STYLE_MAPPING = {
     25: "Synthetic_Cubism",
     26: "Ukiyo_e"
 }
+# Style indices are dense (0..26), so a tuple index replaces the dict lookup.
+STYLE_NAMES = tuple(STYLE_MAPPING[i] for i in range(len(STYLE_MAPPING)))
+STYLE_INDICES = range(len(STYLE_NAMES))
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s"
 )
 
-def build_metadata_dict(json_folder: str) -> dict:
+WRITE_BATCH_SIZE = 1024
+# JSON reads kept submitted per worker thread; bounds the futures alive at once.
+IN_FLIGHT_PER_WORKER = 4
+# One record per watermarked image, written by watermark_generator.process_images.
+METADATA_FILE = "watermarks.jsonl"
+
+def _load_json(path: str) -> dict:
+    """
+    Read and parse a single JSON file.
+    """
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+def _is_metadata_file(entry: os.DirEntry) -> bool:
+    """
+    True for the generator's JSONL metadata file and for legacy per-image JSON sidecars.
+    """
+    return entry.is_file() and (entry.name == METADATA_FILE or entry.name.endswith(".json"))
+
+def _generator_record(info: dict, json_folder: str) -> dict:
     """
-    Parse watermark+style JSON files and construct a metadata dictionary.
+    Convert one watermark_generator metadata line into a metadata dictionary entry.
+    The generator stores no style; merge_annotations takes it from the annotations.
+    """
+    filename = os.path.splitext(info["original"])[0]
+    return {
+        "image_path": os.path.join(json_folder, f"{filename}.png"),
+        "watermark": 1,
+        "text": info["watermark_text"],
+        "style": "Unknown_Style"
+    }
+
+def _map_bounded(ex: ThreadPoolExecutor, fn, items, max_in_flight: int):
+    """
+    Like ex.map, but submit items lazily with at most max_in_flight calls pending.
+    Results are yielded in input order.
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+        pending.append(ex.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+def build_metadata_dict(json_folder: str, max_workers: int = 32) -> dict:
+    """
+    Parse watermark metadata and construct a metadata dictionary.
     Keys are image basenames, values include path, watermark info, text, and style.
+    Reads the generator's METADATA_FILE and any legacy per-image JSON sidecars.
+    Sidecars are read and parsed in a thread pool so open/read latency overlaps;
+    directory entries are submitted as the pool drains, not all up front.
     """
     metadata_dict = {}
-    for filename in os.listdir(json_folder):
-        if filename.endswith(".json"):
-            fpath = os.path.join(json_folder, filename)
-            with open(fpath, "r", encoding="utf-8") as f:
-                data = json.load(f)
+    jsonl_path = os.path.join(json_folder, METADATA_FILE)
+    if os.path.isfile(jsonl_path):
+        for line in _iter_lines(jsonl_path):
+            info = orjson.loads(line)
+            metadata_dict[info["original"]] = _generator_record(info, json_folder)
 
+    with os.scandir(json_folder) as it, ThreadPoolExecutor(max_workers=max_workers) as ex:
+        paths = (entry.path for entry in it if entry.is_file() and entry.name.endswith(".json"))
+        for data in _map_bounded(ex, _load_json, paths, max_workers * IN_FLIGHT_PER_WORKER):
             style_idx = data.get("style")
-            style_name = STYLE_MAPPING.get(style_idx, "Unknown_Style")
+            style_name = STYLE_NAMES[style_idx] if style_idx in STYLE_INDICES else "Unknown_Style"
 
             watermark_texts = [wm["final_text"] for wm in data["watermark"]["watermarks"]]
             num_watermarks = len(watermark_texts)
@@ -68,28 +128,74 @@ def build_metadata_dict(json_folder: str) -> dict:
     logging.info("Metadata dictionary built with %d entries", len(metadata_dict))
     return metadata_dict
 
+def _folder_signature(json_folder: str) -> tuple:
+    """
+    Summarize the metadata files in json_folder as (count, newest mtime in ns, total size).
+    Any added, removed or rewritten file changes the signature.
+    """
+    with os.scandir(json_folder) as it:
+        stats = [entry.stat() for entry in it if _is_metadata_file(entry)]
+    return (len(stats), max((st.st_mtime_ns for st in stats), default=0), sum(st.st_size for st in stats))
+
+def load_metadata_dict(json_folder: str, cache_path: str = None) -> dict:
+    """
+    Return the metadata dictionary for json_folder, reusing a pickled cache
+    when the folder's file signature matches the one it was built from,
+    and rebuilding (and re-caching) it otherwise.
+    """
+    cache_path = Path(cache_path or f"{os.path.normpath(json_folder)}_metadata.pkl")
+    signature = _folder_signature(json_folder)
+    if cache_path.exists():
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+        if isinstance(cached, tuple) and len(cached) == 2 and cached[0] == signature:
+            metadata_dict = cached[1]
+            logging.info("Loaded %d metadata entries from cache %s", len(metadata_dict), cache_path)
+            return metadata_dict
+
+    metadata_dict = build_metadata_dict(json_folder)
+    with open(cache_path, "wb") as f:
+        pickle.dump((signature, metadata_dict), f, protocol=pickle.HIGHEST_PROTOCOL)
+    logging.info("Metadata cache written to %s", cache_path)
+    return metadata_dict
+
+def _iter_lines(path: str):
+    """
+    Yield non-empty lines of a file as bytes through a read-only memory map.
+    """
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line in iter(mm.readline, b""):
+            if line.strip():
+                yield line
+
 def merge_annotations(annotations_file: str, metadata_dict: dict, output_file: str):
     """
     Merge existing annotation records with watermark/style metadata.
     Writes the combined results into a JSONL file.
     """
     count = 0
-    with open(output_file, "w", encoding="utf-8") as out_f:
-        with open(annotations_file, "r", encoding="utf-8") as f:
-            for line in f:
-                ann = json.loads(line)
-                image_name = os.path.basename(ann["image_path"])
-
-                if image_name in metadata_dict:
-                    merged = metadata_dict[image_name].copy()
-                    merged["main_object"] = ann["output"]["main object"]
-
-                    style_idx = ann["output"]["style"]
-                    style_name = STYLE_MAPPING.get(style_idx, "Unknown_Style")
-                    merged["style"] = style_name
-
-                    out_f.write(json.dumps(merged, ensure_ascii=False) + "\n")
-                    count += 1
+    buf = []
+    with open(output_file, "wb") as out_f:
+        for line in _iter_lines(annotations_file):
+            ann = orjson.loads(line)
+            image_name = os.path.basename(ann["image_path"])
+
+            if image_name in metadata_dict:
+                merged = metadata_dict[image_name].copy()
+                merged["main_object"] = ann["output"]["main object"]
+
+                style_idx = ann["output"]["style"]
+                style_name = STYLE_NAMES[style_idx] if style_idx in STYLE_INDICES else "Unknown_Style"
+                merged["style"] = style_name
+
+                buf.append(orjson.dumps(merged) + b"\n")
+                count += 1
+                if len(buf) >= WRITE_BATCH_SIZE:
+                    out_f.writelines(buf)
+                    buf.clear()
+        out_f.writelines(buf)
     logging.info("Merged %d annotation records", count)
 
 def main():
@@ -100,7 +206,7 @@ def main():
     annotations_file = "wikiart_5k_tagged.jsonl"
     output_file = "wikiart_5k_tagged_parsed.jsonl"
 
-    metadata_dict = build_metadata_dict(json_folder)
+    metadata_dict = load_metadata_dict(json_folder)
     merge_annotations(annotations_file, metadata_dict, output_file)
 
 if __name__ == "__main__":
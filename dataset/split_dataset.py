@@ -1,106 +1,127 @@
 import json
-import random
 import logging
 from pathlib import Path
 
+import numpy as np
+import orjson
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s"
 )
 
-def load_and_convert(input_file: str) -> list:
+INSTRUCTION = (
+    "Analyze this image and provide the following information in JSON format: "
+    "watermarks count, text in the image, main object, and visual style."
+)
+# Shared by every converted record; must never be mutated.
+USER_TEXT_CONTENT = {"type": "text", "text": INSTRUCTION}
+WRITE_BATCH_SIZE = 1024
+
+def convert_record(data: dict) -> dict:
     """
-    Load a JSONL dataset and convert each entry into Qwen-compatible conversation format.
+    Convert a single annotation record into Qwen-compatible conversation format.
     """
-    converted_data = []
-    with open(input_file, 'r', encoding="utf-8") as f:
-        for line in f:
-            data = json.loads(line.strip())
-
-            output_json = {
-                "watermarks": data["watermarks"],
-                "text": data["text"],
-                "main object": data["main object"],
-                "style": data["style"]
-            }
+    output_json = {
+        "watermarks": data["watermarks"],
+        "text": data["text"],
+        "main object": data["main object"],
+        "style": data["style"]
+    }
 
-            conversation = {
-                "messages": [
+    return {
+        "messages": [
+            {
+                "role": "user",
+                "content": [
                     {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image",
-                                "image": data["image_path"]
-                            },
-                            {
-                                "type": "text",
-                                "text": (
-                                    "Analyze this image and provide the following information in JSON format: "
-                                    "watermarks count, text in the image, main object, and visual style."
-                                )
-                            }
-                        ]
+                        "type": "image",
+                        "image": data["image_path"]
                     },
+                    USER_TEXT_CONTENT
+                ]
+            },
+            {
+                "role": "assistant",
+                "content": [
                     {
-                        "role": "assistant",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": json.dumps(output_json, ensure_ascii=False, indent=0).replace('\n', '\\n')
-                            }
-                        ]
+                        "type": "text",
+                        "text": orjson.dumps(output_json).decode()
                     }
                 ]
             }
+        ]
+    }
 
-            converted_data.append(conversation)
+def load_and_convert(input_file: str) -> list:
+    """
+    Load a JSONL dataset and convert each entry into Qwen-compatible conversation format.
+    """
+    converted_data = []
+    with open(input_file, 'r', encoding="utf-8") as f:
+        for line in f:
+            data = json.loads(line.strip())
+            converted_data.append(convert_record(data))
     logging.info("Converted %d records into Qwen format", len(converted_data))
     return converted_data
 
-def split_data(data: list, train_ratio=0.8, val_ratio=0.1, test_ratio=0.1):
+def index_records(input_file: str) -> np.ndarray:
+    """
+    Return the byte offset of every non-empty line of a JSONL file, without parsing them.
+    """
+    offsets = []
+    pos = 0
+    with open(input_file, "rb") as f:
+        for line in f:
+            if line.strip():
+                offsets.append(pos)
+            pos += len(line)
+    return np.array(offsets, dtype=np.int64)
+
+def split_indices(total_samples: int, train_ratio=0.8, val_ratio=0.1, test_ratio=0.1) -> dict:
     """
-    Shuffle and split the dataset into train/val/test according to given ratios.
+    Shuffle record indices and split them into train/val/test according to given ratios.
     """
     assert abs(train_ratio + val_ratio + test_ratio - 1.0) < 1e-5, "Ratios must sum to 1"
-    random.shuffle(data)
 
-    total_samples = len(data)
     train_size = int(total_samples * train_ratio)
     val_size = int(total_samples * val_ratio)
 
-    train_data = data[:train_size]
-    val_data = data[train_size:train_size + val_size]
-    test_data = data[train_size + val_size:]
-
-    logging.info("Dataset split complete: total=%d, train=%d, val=%d, test=%d",
-                 total_samples, len(train_data), len(val_data), len(test_data))
+    perm = np.random.permutation(total_samples)
     return {
-        "train": train_data,
-        "val": val_data,
-        "test": test_data
+        "train": perm[:train_size],
+        "val": perm[train_size:train_size + val_size],
+        "test": perm[train_size + val_size:]
     }
 
-def save_splits(splits: dict, output_dir: str):
+def convert_and_split_dataset(input_file, output_dir, train_ratio=0.8, val_ratio=0.1, test_ratio=0.1):
     """
-    Save split datasets into JSON files within the output directory.
+    End-to-end process: index record offsets, shuffle and split the indices, then read
+    each split's records in shuffled order, converting and writing them to its JSONL file.
+    Only the offset and index arrays are held in memory.
     """
+    offsets = index_records(input_file)
+    splits = split_indices(len(offsets), train_ratio, val_ratio, test_ratio)
+
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
 
-    for split_name, split_data in splits.items():
-        output_file = output_path / f"{split_name}.json"
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(split_data, f, ensure_ascii=False, indent=2)
-        logging.info("Saved %d samples to %s", len(split_data), output_file)
-
-def convert_and_split_dataset(input_file, output_dir, train_ratio=0.8, val_ratio=0.1, test_ratio=0.1):
-    """
-    End-to-end process: load + convert dataset, split into subsets, and save them.
-    """
-    data = load_and_convert(input_file)
-    splits = split_data(data, train_ratio, val_ratio, test_ratio)
-    save_splits(splits, output_dir)
+    logging.info("Dataset split complete: total=%d, train=%d, val=%d, test=%d",
+                 len(offsets), *(len(indices) for indices in splits.values()))
+    with open(input_file, "rb") as f:
+        for split_name, indices in splits.items():
+            output_file = output_path / f"{split_name}.jsonl"
+            buf = []
+            with open(output_file, "wb") as out_f:
+                for i in indices:
+                    f.seek(offsets[i])
+                    record = convert_record(json.loads(f.readline()))
+                    buf.append(orjson.dumps(record) + b"\n")
+                    if len(buf) >= WRITE_BATCH_SIZE:
+                        out_f.writelines(buf)
+                        buf.clear()
+                out_f.writelines(buf)
+            logging.info("Saved %d samples to %s", len(indices), output_file)
 
 def main():
     """
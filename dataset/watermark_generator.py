@@ -1,21 +1,81 @@
 import os
 import json
-import glob
+import time
 import random
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache, partial
 from pathlib import Path
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
+from tqdm import tqdm
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s"
 )
 
+FONT_PATH = "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf"
+FONT_SIZE = 50
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Fastest zlib level: output stays lossless PNG, encode is several times cheaper than the default 6.
+PNG_COMPRESS_LEVEL = 1
+# Images per process-pool task; within a task, PNG saves overlap with drawing the next image.
+WORKER_BATCH_SIZE = 16
+# One JSON line per watermarked image; read back by parse_styles.build_metadata_dict.
+METADATA_FILE = "watermarks.jsonl"
+
+@lru_cache(maxsize=256)
+def _load_font(path: str, size: int):
+    """
+    Load a TrueType font once per (path, size), falling back to PIL's default font.
+    """
+    try:
+        return ImageFont.truetype(path, size)
+    except Exception:
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=4096)
+def _measure_text(text: str, font_path: str, font_size: int) -> tuple:
+    """
+    Return the text bounding box at origin, measured once per (text, font).
+    """
+    draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    return draw.textbbox((0, 0), text, font=_load_font(font_path, font_size))
+
+@lru_cache(maxsize=4096)
+def _render_text(text: str, font_path: str, font_size: int) -> np.ndarray:
+    """
+    Rasterize the text once per (text, font) into a tight uint8 coverage mask.
+    """
+    bbox = _measure_text(text, font_path, font_size)
+    mask = Image.new('L', (bbox[2] - bbox[0], bbox[3] - bbox[1]), 0)
+    ImageDraw.Draw(mask).text((-bbox[0], -bbox[1]), text, font=_load_font(font_path, font_size), fill=255)
+    arr = np.asarray(mask)
+    arr.flags.writeable = False
+    return arr
+
+def _blend_sprite(base: Image.Image, mask: np.ndarray, fill: tuple, xy: tuple):
+    """
+    Alpha-blend the RGBA fill through a coverage mask onto the RGB base in place at xy, clipped to the image.
+    """
+    left, top = xy
+    right = min(base.width, left + mask.shape[1])
+    bottom = min(base.height, top + mask.shape[0])
+    if left >= right or top >= bottom:
+        return
+    box = (left, top, right, bottom)
+    a = (mask[:bottom - top, :right - left, None].astype(np.uint16) * fill[3] + 127) // 255
+    color = np.array(fill[:3], dtype=np.uint16)
+    rgb = np.asarray(base.crop(box), dtype=np.uint16)
+    out = (color * a + rgb * (255 - a) + 127) // 255
+    base.paste(Image.fromarray(out.astype(np.uint8), 'RGB'), box[:2])
+
 class SimpleTextWatermark:
     """
     Utility for adding simple random text watermarks to images.
-    Produces both watermarked PNG images and corresponding JSON metadata.
+    Produces watermarked PNG images and returns their metadata as dicts.
     """
     def __init__(self):
         self.texts = [
@@ -32,83 +92,123 @@ class SimpleTextWatermark:
             "CLIENT COPY","WIP","WORK-IN-PROGRESS","UNAUTHORIZED COPYING","EXAMPLE",
             "STAGING","BACKUP","MIGRATION","LEGACY","REFERENCE","HOLD"
         ]
+        self.font = _load_font(FONT_PATH, FONT_SIZE)
 
-    def add_watermark(self, image_path: str, output_folder: str) -> bool:
+    def _render(self, image_path: str, timestamp: str) -> tuple:
         """
-        Add a semi-transparent text watermark at a random position inside the image.
-        Save both modified image (PNG) and metadata JSON.
-
-        Args:
-            image_path: Path to input image
-            output_folder: Folder to save output PNG and JSON
+        Draw a random watermark on the image and return (watermarked RGB image, metadata).
         """
-        try:
-            img = Image.open(image_path).convert('RGBA')
-            width, height = img.size
-
-            overlay = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-            draw = ImageDraw.Draw(overlay)
-
-            text = random.choice(self.texts)
-            number = random.randint(1, 5)
-            watermark_text = f"{text} {number}"
-
-            try:
-                font = ImageFont.truetype(
-                    "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf", 50
-                )
-            except Exception:
-                font = ImageFont.load_default()
-
-            bbox = draw.textbbox((0, 0), watermark_text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
+        img = Image.open(image_path)
+        img = img.convert('RGB') if img.mode != 'RGB' else img
+        width, height = img.size
 
-            x = random.randint(50, max(51, width - text_width - 50))
-            y = random.randint(50, max(51, height - text_height - 50))
+        text = random.choice(self.texts)
+        number = random.randint(1, 5)
+        watermark_text = f"{text} {number}"
 
-            colors = [(255, 255, 255), (200, 200, 200), (150, 150, 255)]
-            color = random.choice(colors)
+        bbox = _measure_text(watermark_text, FONT_PATH, FONT_SIZE)
+        text_width = bbox[2] - bbox[0]
+        text_height = bbox[3] - bbox[1]
 
-            draw.text((x, y), watermark_text, font=font, fill=(*color, 100))
+        x = random.randint(50, max(51, width - text_width - 50))
+        y = random.randint(50, max(51, height - text_height - 50))
 
-            watermarked = Image.alpha_composite(img, overlay).convert('RGB')
+        colors = [(255, 255, 255), (200, 200, 200), (150, 150, 255)]
+        color = random.choice(colors)
 
-            filename = os.path.splitext(os.path.basename(image_path))[0]
-            output_path = os.path.join(output_folder, f"{filename}.png")
-            watermarked.save(output_path)
+        mask = _render_text(watermark_text, FONT_PATH, FONT_SIZE)
+        _blend_sprite(img, mask, (*color, 100), (x + bbox[0], y + bbox[1]))
 
-            info = {
-                "original": os.path.basename(image_path),
-                "watermark_text": watermark_text,
-                "position": [x, y],
-                "color": color,
-                "timestamp": datetime.now().isoformat()
-            }
+        info = {
+            "original": os.path.basename(image_path),
+            "watermark_text": watermark_text,
+            "position": [x, y],
+            "color": color,
+            "timestamp": timestamp
+        }
+        return img, info
 
-            json_path = os.path.join(output_folder, f"{filename}.json")
-            with open(json_path, "w", encoding="utf-8") as f:
-                json.dump(info, f, indent=2)
+    def _save(self, watermarked: Image.Image, info: dict, output_folder: str):
+        """
+        Write the watermarked PNG.
+        """
+        filename = os.path.splitext(info["original"])[0]
+        output_path = os.path.join(output_folder, f"{filename}.png")
+        watermarked.save(output_path, compress_level=PNG_COMPRESS_LEVEL)
 
-            return True
+    def add_watermark(self, image_path: str, output_folder: str, run_ts: str = None) -> dict:
+        """
+        Add a semi-transparent text watermark at a random position inside the image.
+        Save the modified image (PNG) and return its metadata, or None on failure.
 
+        Args:
+            image_path: Path to input image
+            output_folder: Folder to save output PNG
+            run_ts: Timestamp recorded in the metadata; defaults to now
+        """
+        try:
+            watermarked, info = self._render(image_path, run_ts or datetime.now().isoformat())
+            self._save(watermarked, info, output_folder)
+            return info
         except Exception as e:
             logging.error("Processing failed for %s: %s", image_path, e)
-            return False
+            return None
+
+    def add_watermarks(self, image_paths: list, output_folder: str, run_ts: str = None) -> list:
+        """
+        Watermark a batch of images, saving image N on a background thread
+        while image N+1 is being drawn. Returns one metadata dict (None on failure) per image.
+        All images share one metadata timestamp, run_ts (defaults to now).
+        """
+        run_ts = run_ts or datetime.now().isoformat()
+
+        def save(watermarked, info, image_path):
+            try:
+                self._save(watermarked, info, output_folder)
+                return info
+            except Exception as e:
+                logging.error("Processing failed for %s: %s", image_path, e)
+                return None
+
+        pending = []
+        with ThreadPoolExecutor(max_workers=1) as saver:
+            for image_path in image_paths:
+                try:
+                    watermarked, info = self._render(image_path, run_ts)
+                except Exception as e:
+                    logging.error("Processing failed for %s: %s", image_path, e)
+                    pending.append(None)
+                    continue
+                pending.append(saver.submit(save, watermarked, info, image_path))
+        return [fut.result() if fut is not None else None for fut in pending]
 
 def collect_images(input_folder: str) -> list:
     """
     Find all images (JPG/PNG) in the input folder.
     """
-    image_types = ['*.jpg', '*.jpeg', '*.png']
-    all_images = []
-    for img_type in image_types:
-        all_images.extend(glob.glob(os.path.join(input_folder, img_type)))
-    return all_images
+    with os.scandir(input_folder) as entries:
+        return [entry.path for entry in entries if entry.name.lower().endswith(IMAGE_EXTENSIONS)]
+
+_worker_watermarker = None
+
+def _init_worker():
+    """
+    Build one SimpleTextWatermark per worker process and give it its own random seed.
+    """
+    global _worker_watermarker
+    random.seed(os.getpid() + time.time_ns())
+    _worker_watermarker = SimpleTextWatermark()
 
-def process_images(input_folder: str, output_folder: str):
+def _watermark_batch(image_paths: list, output_folder: str, run_ts: str) -> list:
+    """
+    Apply watermarks to a batch of images using the worker's SimpleTextWatermark.
     """
-    Iterate over images, apply watermarks, and save results.
+    return _worker_watermarker.add_watermarks(image_paths, output_folder, run_ts)
+
+def process_images(input_folder: str, output_folder: str, max_workers: int = None):
+    """
+    Iterate over images, apply watermarks in a process pool, and save results.
+    Metadata for every watermarked image is written by this process to one JSONL file.
     """
     Path(output_folder).mkdir(parents=True, exist_ok=True)
 
@@ -119,13 +219,20 @@ def process_images(input_folder: str, output_folder: str):
 
     logging.info("Found %d images", len(all_images))
 
-    watermarker = SimpleTextWatermark()
     success = 0
-
-    for i, image_path in enumerate(all_images, 1):
-        logging.info("Processing %d/%d: %s", i, len(all_images), os.path.basename(image_path))
-        if watermarker.add_watermark(image_path, output_folder):
-            success += 1
+    run_ts = datetime.now().isoformat()
+    worker = partial(_watermark_batch, output_folder=output_folder, run_ts=run_ts)
+    batches = [all_images[i:i + WORKER_BATCH_SIZE] for i in range(0, len(all_images), WORKER_BATCH_SIZE)]
+    metadata_path = os.path.join(output_folder, METADATA_FILE)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as ex, \
+            open(metadata_path, "w", encoding="utf-8") as meta_f:
+        with tqdm(total=len(all_images), desc="Watermarking") as pbar:
+            for batch in ex.map(worker, batches):
+                for info in batch:
+                    if info is not None:
+                        meta_f.write(json.dumps(info) + "\n")
+                        success += 1
+                pbar.update(len(batch))
 
     logging.info("Completed. Successfully processed %d/%d images. Output saved to: %s",
                  success, len(all_images), output_folder)
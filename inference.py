@@ -1,15 +1,21 @@
-import json
-import re
+import os
+import copy
+import inspect
+import importlib.util
+import importlib.metadata
 import argparse
 import logging
 from pathlib import Path
 from typing import Union, List, Dict, Optional
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
+import orjson
 import torch
 from PIL import Image
 from tqdm import tqdm
 from pydantic import BaseModel, Field
+from transformers import StoppingCriteria, StoppingCriteriaList
 from unsloth import FastVisionModel
 
 logging.basicConfig(
@@ -18,11 +24,141 @@ logging.basicConfig(
 )
 
 
+def _last_json_span(text: str) -> Optional[str]:
+    """
+    Return the last balanced {...} object in text by scanning backward from
+    the final closing brace, honouring string literals and escapes.
+    """
+    end = text.rfind("}")
+    if end < 0:
+        return None
+
+    depth = 0
+    in_string = False
+    for i in range(end, -1, -1):
+        c = text[i]
+        if c == '"':
+            backslashes = 0
+            j = i - 1
+            while j >= 0 and text[j] == "\\":
+                backslashes += 1
+                j -= 1
+            if backslashes % 2 == 0:
+                in_string = not in_string
+        elif not in_string:
+            if c == "}":
+                depth += 1
+            elif c == "{":
+                depth -= 1
+                if depth == 0:
+                    return text[i:end + 1]
+    return None
+
+
+def _find_json_spans(text: str) -> List[str]:
+    """
+    Return every outermost balanced {...} span in text, in a single left-to-right pass.
+    """
+    first, last = text.find("{"), text.rfind("}")
+    if first < 0 or last < first:
+        return []
+    if text.find("{", first + 1) < 0:
+        return [text[first:last + 1]]
+
+    spans = []
+    depth = 0
+    start = 0
+    for i in range(first, last + 1):
+        c = text[i]
+        if c == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                spans.append(text[start:i + 1])
+    return spans
+
+
+class JsonBraceStop(StoppingCriteria):
+    """
+    Stop each sequence once the first JSON object it generates is closed.
+    Only the newest token per row is decoded on each step; brace depth and
+    string/backslash state are carried across steps.
+    Escaped JSON (every quote written with a backslash), which _extract_json_from_output
+    also accepts, is detected from the first quote and handled the same way.
+    """
+
+    def __init__(self, tokenizer, batch_size: int):
+        self.tokenizer = tokenizer
+        self.depth = [0] * batch_size
+        self.started = [False] * batch_size
+        self.in_string = [False] * batch_size
+        self.backslashes = [0] * batch_size
+        # None until the row's first quote; then whether its quotes are written as \".
+        self.escaped_json = [None] * batch_size
+        self.done = [False] * batch_size
+
+    def _is_delimiter(self, row: int, backslashes: int) -> bool:
+        """
+        Whether a quote preceded by this many backslashes opens or closes a string.
+        Plain JSON: an even run, so the quote itself is unescaped.
+        Escaped JSON: a run of 4k + 1, the escaped form of an unescaped quote.
+        """
+        if self.escaped_json[row] is None:
+            self.escaped_json[row] = backslashes % 2 == 1
+        if self.escaped_json[row]:
+            return backslashes % 4 == 1
+        return backslashes % 2 == 0
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        pieces = self.tokenizer.batch_decode(input_ids[:, -1:])
+        for row, piece in enumerate(pieces):
+            if self.done[row]:
+                continue
+            for c in piece:
+                if c == "\\":
+                    self.backslashes[row] += 1
+                    continue
+                backslashes, self.backslashes[row] = self.backslashes[row], 0
+                if c == '"':
+                    if self.started[row] and self._is_delimiter(row, backslashes):
+                        self.in_string[row] = not self.in_string[row]
+                elif self.in_string[row]:
+                    continue
+                elif c == "{":
+                    self.depth[row] += 1
+                    self.started[row] = True
+                elif c == "}" and self.started[row]:
+                    self.depth[row] -= 1
+                    if self.depth[row] == 0:
+                        self.done[row] = True
+                        break
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+
 class Config:
     MODEL_NAME = "lora_model"
-    LOAD_IN_4BIT = True
+    # Weight quantization used when loading the model; one of QUANT_MODES.
+    QUANT_MODE = "bnb-4bit"
+    QUANT_MODES = {
+        "bnb-4bit": {"load_in_4bit": True},
+        "bnb-8bit": {"load_in_4bit": False, "load_in_8bit": True},
+        "fp8": {"load_in_4bit": False, "load_in_fp8": True},
+        "16bit": {"load_in_4bit": False},
+    }
     MAX_NEW_TOKENS = 128
-    TEMPERATURE = 0.1
+    BATCH_SIZE = 8
+    PREFETCH_WORKERS = 4
+    # FlashAttention-2 when the flash_attn package is installed, PyTorch SDPA otherwise.
+    ATTN_IMPLEMENTATION = "flash_attention_2" if importlib.util.find_spec("flash_attn") else "sdpa"
+    # Set to 4 or 8 to quantize the KV cache (needs optimum-quanto); None keeps it in FP16.
+    KV_CACHE_NBITS = None
+    # Kernel fusion without CUDA graphs: prompt lengths vary with image size,
+    # so shapes are compiled dynamically instead of captured per shape.
+    COMPILE_MODE = "max-autotune-no-cudagraphs"
+    COMPILE_WARMUP_STEPS = 1
 
     ART_STYLES = [
         "Abstract_Expressionism", "Action_painting", "Analytical_Cubism",
@@ -35,25 +171,57 @@ class Config:
     ]
 
 
+def _check_quant_mode(quant_mode: str):
+    """
+    Raise ValueError if quant_mode is unknown or needs a loader flag that the
+    installed unsloth's FastVisionModel.from_pretrained does not accept.
+    """
+    if quant_mode not in Config.QUANT_MODES:
+        raise ValueError(f"Unknown quant mode: {quant_mode}")
+    params = inspect.signature(FastVisionModel.from_pretrained).parameters
+    missing = [flag for flag, on in Config.QUANT_MODES[quant_mode].items() if on and flag not in params]
+    if missing:
+        raise ValueError(
+            f"Quant mode {quant_mode} needs {', '.join(missing)}, which unsloth "
+            f"{importlib.metadata.version('unsloth')} does not support; upgrade unsloth or pick another mode"
+        )
+
+
 class ImageAnalysis(BaseModel):
     watermarks: int = Field(ge=0, description="Number of watermarks detected")
     text: str = Field(description="Text detected in the image")
     main_object: str = Field(description="Primary subject of the image")
     style: str = Field(description="Art style of the image")
     image_path: Optional[str] = Field(None, description="Path to the analyzed image")
+    image_name: Optional[str] = Field(None, description="File name of the analyzed image")
 
 
 class ImageAnalyzer:
-    def __init__(self, model_name: str = Config.MODEL_NAME, load_in_4bit: bool = Config.LOAD_IN_4BIT):
+    def __init__(self, model_name: str = Config.MODEL_NAME, quant_mode: str = Config.QUANT_MODE,
+                 kv_cache_nbits: Optional[int] = Config.KV_CACHE_NBITS, compile_model: bool = False,
+                 batch_size: int = Config.BATCH_SIZE):
         """
         Initialize the VLM model and tokenizer.
+        With compile_model, warm-up runs at batch_size, the batch size later analysis will use.
         """
-        logging.info("Loading model: %s", model_name)
+        _check_quant_mode(quant_mode)
+
+        logging.info("Loading model: %s (quant: %s, attention: %s)",
+                     model_name, quant_mode, Config.ATTN_IMPLEMENTATION)
         self.model, self.tokenizer = FastVisionModel.from_pretrained(
             model_name=model_name,
-            load_in_4bit=load_in_4bit
+            attn_implementation=Config.ATTN_IMPLEMENTATION,
+            **Config.QUANT_MODES[quant_mode]
         )
         FastVisionModel.for_inference(self.model)
+        if kv_cache_nbits:
+            self.model.generation_config.cache_implementation = "quantized"
+            self.model.generation_config.cache_config = {"backend": "quanto", "nbits": kv_cache_nbits}
+            logging.info("Using %d-bit quantized KV cache", kv_cache_nbits)
+        # The processor wraps a text tokenizer; decoder-only batched generation
+        # needs prompts padded on the left so they end at the same position.
+        self.text_tokenizer = getattr(self.tokenizer, "tokenizer", self.tokenizer)
+        self.text_tokenizer.padding_side = "left"
         logging.info("Model loaded successfully")
 
         self.instruction = (
@@ -61,16 +229,60 @@ class ImageAnalyzer:
             "watermarks count, text in the image, main object, and visual style."
         )
 
-    def _extract_json_from_output(self, raw_output: Union[str, List]) -> Dict:
+        # The prompt is the same for every image (the image only fills the
+        # placeholder), so the chat template is rendered once.
+        messages = [{
+            "role": "user",
+            "content": [
+                {"type": "image"},
+                {"type": "text", "text": self.instruction}
+            ]
+        }]
+        self.input_text = self.tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True
+        )
+        self._prompt_parts = self._split_prompt()
+
+        if compile_model:
+            self._compile(batch_size)
+
+    def _compile(self, batch_size: int = Config.BATCH_SIZE):
+        """
+        Compile the model forward with torch.compile and warm it up at batch_size
+        so that compilation happens before real images arrive.
+        """
+        if tuple(int(v) for v in torch.__version__.split(".")[:2]) < (2, 2):
+            logging.warning("torch.compile needs torch>=2.2, found %s; running uncompiled", torch.__version__)
+            return
+
+        logging.info("Compiling model forward (mode=%s)", Config.COMPILE_MODE)
+        self.model.forward = torch.compile(
+            self.model.forward, mode=Config.COMPILE_MODE, dynamic=True, fullgraph=False
+        )
+
+        dummy = Image.new("RGB", (448, 448))
+        for _ in range(Config.COMPILE_WARMUP_STEPS):
+            self._generate([dummy] * batch_size)
+        logging.info("Model compiled")
+
+    def _extract_json_from_output(self, raw_output: Union[str, List]) -> ImageAnalysis:
         """
         Extract valid JSON object from model output text.
         """
+        if isinstance(raw_output, str):
+            span = _last_json_span(raw_output)
+            if span is not None:
+                try:
+                    return self._validate_output(orjson.loads(span))
+                except Exception:
+                    pass
+
         if isinstance(raw_output, list):
             candidates = raw_output
         else:
             if isinstance(raw_output, str):
                 raw_output = raw_output.strip().replace('\\"', '"')
-            candidates = re.findall(r"\{[\s\S]*?\}", raw_output)
+            candidates = _find_json_spans(raw_output)
 
         if not candidates:
             raise ValueError("No JSON object found in output")
@@ -78,19 +290,111 @@ class ImageAnalyzer:
         for candidate in reversed(candidates):
             try:
                 decoded = candidate.encode().decode("unicode_escape")
-                parsed = json.loads(decoded)
-
-                if "main object" in parsed:
-                    parsed["main_object"] = parsed.pop("main object")
-
-                validated = ImageAnalysis.model_validate(parsed)
-                return validated.model_dump()
-
+                return self._validate_output(orjson.loads(decoded))
             except Exception:
                 continue
 
         raise RuntimeError("No valid JSON found in model output")
 
+    @staticmethod
+    def _validate_output(parsed: Dict) -> ImageAnalysis:
+        """
+        Normalize the model's key names and validate against ImageAnalysis.
+        """
+        if "main object" in parsed:
+            parsed["main_object"] = parsed.pop("main object")
+
+        return ImageAnalysis.model_validate(parsed)
+
+    def _split_prompt(self) -> Optional[tuple]:
+        """
+        Tokenize the cached prompt once and split it around its image placeholder.
+        Returns (ids before, placeholder id, ids after), or None when the processor
+        does not expand the placeholder per image grid (non Qwen-VL style models).
+        """
+        image_token = getattr(self.tokenizer, "image_token", None)
+        image_processor = getattr(self.tokenizer, "image_processor", None)
+        if image_token is None or not hasattr(image_processor, "merge_size"):
+            return None
+
+        ids = self.text_tokenizer(self.input_text, add_special_tokens=False)["input_ids"]
+        image_token_id = self.text_tokenizer.convert_tokens_to_ids(image_token)
+        if ids.count(image_token_id) != 1:
+            return None
+        split = ids.index(image_token_id)
+        return ids[:split], image_token_id, ids[split + 1:]
+
+    def _assemble_inputs(self, images: List[Image.Image], image_processor) -> Dict[str, torch.Tensor]:
+        """
+        Build model inputs from the pre-tokenized prompt: only the images go through
+        the image processor, and each row's placeholder is repeated once per merged
+        vision patch, left-padded to the longest row.
+        """
+        before, image_token_id, after = self._prompt_parts
+        vision = image_processor(images=images, return_tensors="pt")
+        counts = (vision["image_grid_thw"].prod(dim=-1) // image_processor.merge_size ** 2).tolist()
+
+        lengths = [len(before) + count + len(after) for count in counts]
+        max_len = max(lengths)
+        input_ids = torch.full((len(images), max_len), self.text_tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(images), max_len), dtype=torch.long)
+        for row, (count, length) in enumerate(zip(counts, lengths)):
+            input_ids[row, max_len - length:] = torch.tensor(before + [image_token_id] * count + after)
+            attention_mask[row, max_len - length:] = 1
+
+        return {"input_ids": input_ids, "attention_mask": attention_mask, **vision}
+
+    def _prepare_inputs(self, images: List[Image.Image], tokenizer=None) -> Dict[str, torch.Tensor]:
+        """
+        Build the padded model inputs for a batch of images in pinned host memory.
+        A separate tokenizer copy may be passed when called from a background thread.
+        """
+        tokenizer = tokenizer or self.tokenizer
+        if self._prompt_parts is not None:
+            inputs = self._assemble_inputs(images, tokenizer.image_processor)
+        else:
+            inputs = tokenizer(
+                images, [self.input_text] * len(images),
+                add_special_tokens=False, padding=True, return_tensors="pt"
+            )
+        return {
+            key: value.pin_memory() if isinstance(value, torch.Tensor) else value
+            for key, value in inputs.items()
+        }
+
+    def _generate(self, images: List[Image.Image]) -> List[str]:
+        """
+        Run one batched generate call over the images and return the decoded
+        generated text (prompt tokens excluded) for each image.
+        """
+        return self._generate_from_inputs(self._prepare_inputs(images))
+
+    def _generate_from_inputs(self, inputs: Dict[str, torch.Tensor]) -> List[str]:
+        """
+        Copy prepared (pinned) inputs to the GPU asynchronously, generate, and decode.
+        """
+        inputs = {
+            key: value.to("cuda", non_blocking=True) if isinstance(value, torch.Tensor) else value
+            for key, value in inputs.items()
+        }
+        batch_size = inputs["input_ids"].shape[0]
+
+        with torch.inference_mode():
+            output = self.model.generate(
+                **inputs,
+                max_new_tokens=Config.MAX_NEW_TOKENS,
+                do_sample=False,
+                num_beams=1,
+                use_cache=True,
+                pad_token_id=self.text_tokenizer.pad_token_id,
+                eos_token_id=self.text_tokenizer.eos_token_id,
+                stopping_criteria=StoppingCriteriaList([JsonBraceStop(self.text_tokenizer, batch_size)])
+            )
+
+        # Prompts are left-padded to a common length, so generation starts at the same index in every row.
+        prompt_len = inputs["input_ids"].shape[-1]
+        return self.tokenizer.batch_decode(output[:, prompt_len:], skip_special_tokens=True)
+
     def analyze_image(self, image_path: Union[str, Path]) -> ImageAnalysis:
         """
         Analyze a single image and return an ImageAnalysis object.
@@ -101,38 +405,66 @@ class ImageAnalyzer:
 
         image = Image.open(image_path).convert("RGB")
 
-        messages = [{
-            "role": "user",
-            "content": [
-                {"type": "image", "image": image},
-                {"type": "text", "text": self.instruction}
-            ]
-        }]
+        raw_output = self._generate([image])[0]
+        result = self._extract_json_from_output(raw_output)
+        result.image_path = str(image_path)
+        result.image_name = image_path.name
 
-        input_text = self.tokenizer.apply_chat_template(
-            messages, add_generation_prompt=True
-        )
-        inputs = self.tokenizer(
-            image, input_text, add_special_tokens=False, return_tensors="pt"
-        ).to("cuda")
+        return result
 
-        with torch.no_grad():
-            output = self.model.generate(
-                **inputs,
-                max_new_tokens=Config.MAX_NEW_TOKENS,
-                temperature=Config.TEMPERATURE,
-                use_cache=True
-            ).to("cuda")
+    @staticmethod
+    def _load_image(image_path: Path) -> Optional[Image.Image]:
+        """
+        Open an image as RGB, logging and returning None if it cannot be read.
+        """
+        try:
+            return Image.open(image_path).convert("RGB")
+        except Exception as e:
+            logging.error("Error processing %s: %s", image_path.name, e)
+            return None
+
+    def _prepare_batch(self, image_paths: List[Path], pool: Optional[ThreadPoolExecutor] = None,
+                       tokenizer=None) -> tuple:
+        """
+        Load a batch of images (in parallel when a pool is given) and build its
+        pinned model inputs. Returns (loaded paths, inputs); inputs is None when
+        no image could be loaded.
+        """
+        load = pool.map if pool is not None else map
+        images = list(load(self._load_image, image_paths))
 
-        raw_output = self.tokenizer.decode(output[0], skip_special_tokens=True)
-        result = self._extract_json_from_output(raw_output)
-        result["image_path"] = str(image_path)
+        loaded = [(path, image) for path, image in zip(image_paths, images) if image is not None]
+        if not loaded:
+            return [], None
+        loaded_paths, images = zip(*loaded)
+        return list(loaded_paths), self._prepare_inputs(list(images), tokenizer)
+
+    def analyze_batch(self, image_paths: List[Path], prepared: Optional[tuple] = None) -> List[ImageAnalysis]:
+        """
+        Analyze a batch of images with a single generate call.
+        The output of _prepare_batch may be passed in when it was built ahead of time.
+        Images that fail to load or parse are logged and skipped.
+        """
+        loaded_paths, inputs = prepared if prepared is not None else self._prepare_batch(image_paths)
+        if inputs is None:
+            return []
+
+        results = []
+        for image_path, raw_output in zip(loaded_paths, self._generate_from_inputs(inputs)):
+            try:
+                result = self._extract_json_from_output(raw_output)
+                result.image_path = str(image_path)
+                result.image_name = image_path.name
+                results.append(result)
+            except Exception as e:
+                logging.error("Error processing %s: %s", image_path.name, e)
 
-        return ImageAnalysis(**result)
+        return results
 
-    def analyze_folder(self, folder_path: Union[str, Path], extensions: List[str] = None) -> List[ImageAnalysis]:
+    def analyze_folder(self, folder_path: Union[str, Path], extensions: List[str] = None,
+                       batch_size: int = Config.BATCH_SIZE) -> List[ImageAnalysis]:
         """
-        Analyze all images inside a folder.
+        Analyze all images inside a folder, batch_size images per generate call.
         """
         folder_path = Path(folder_path)
         if not folder_path.exists():
@@ -141,24 +473,47 @@ class ImageAnalyzer:
         if extensions is None:
             extensions = [".jpg", ".jpeg", ".png", ".bmp", ".webp"]
 
-        image_files = []
-        for ext in extensions:
-            image_files.extend(folder_path.glob(f"*{ext}"))
-            image_files.extend(folder_path.glob(f"*{ext.upper()}"))
+        exts = {ext.lower() for ext in extensions}
+        with os.scandir(folder_path) as entries:
+            image_files = [
+                Path(entry.path) for entry in entries
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in exts
+            ]
 
         if not image_files:
             logging.warning("No images found in %s", folder_path)
             return []
 
+        batches = [image_files[i:i + batch_size] for i in range(0, len(image_files), batch_size)]
+
         results = []
-        for image_path in tqdm(image_files, desc="Analyzing images"):
-            try:
-                result = self.analyze_image(image_path)
-                results.append(result)
-                logging.info("Analyzed %s: main_object=%s style=%s",
-                             image_path.name, result.main_object, result.style)
-            except Exception as e:
-                logging.error("Error processing %s: %s", image_path.name, e)
+        # The next batch is decoded (on PREFETCH_WORKERS threads) and tokenized
+        # into pinned memory while the current batch is on the GPU. The
+        # preparing thread gets its own tokenizer copy: fast tokenizers are not
+        # safe to use from two threads at once.
+        prep_tokenizer = copy.deepcopy(self.tokenizer)
+        with ThreadPoolExecutor(max_workers=Config.PREFETCH_WORKERS) as load_pool, \
+                ThreadPoolExecutor(max_workers=1) as prep_pool, \
+                tqdm(total=len(image_files), desc="Analyzing images") as pbar:
+            pending = prep_pool.submit(self._prepare_batch, batches[0], load_pool, prep_tokenizer)
+            for i, batch in enumerate(batches):
+                try:
+                    prepared = pending.result()
+                except Exception as e:
+                    logging.error("Error preparing batch starting at %s: %s", batch[0].name, e)
+                    prepared = ([], None)
+                if i + 1 < len(batches):
+                    pending = prep_pool.submit(self._prepare_batch, batches[i + 1], load_pool, prep_tokenizer)
+                try:
+                    batch_results = self.analyze_batch(batch, prepared)
+                except Exception as e:
+                    logging.error("Error processing batch starting at %s: %s", batch[0].name, e)
+                    batch_results = []
+                for result in batch_results:
+                    logging.info("Analyzed %s: main_object=%s style=%s",
+                                 result.image_name, result.main_object, result.style)
+                results.extend(batch_results)
+                pbar.update(len(batch))
 
         return results
 
@@ -171,8 +526,8 @@ def save_results(results: List[ImageAnalysis], output_path: Union[str, Path]):
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
     data = [result.model_dump() for result in results]
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    with open(output_path, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
     logging.info("Results saved to %s", output_path)
 
@@ -185,7 +540,7 @@ def log_results(results: List[ImageAnalysis]):
     for result in results:
         logging.info(
             "Image=%s | Main=%s | Style=%s | Watermarks=%s | Text=%s",
-            Path(result.image_path).name,
+            result.image_name,
             result.main_object,
             result.style,
             result.watermarks,
@@ -203,20 +558,32 @@ def main():
     parser.add_argument("--folder", type=str, help="Path to folder of images")
     parser.add_argument("--output", type=str, help="Output JSON path")
     parser.add_argument("--model", type=str, default=Config.MODEL_NAME, help="Model name to use")
+    parser.add_argument("--quant", type=str, default=Config.QUANT_MODE, choices=list(Config.QUANT_MODES),
+                        help="Weight quantization to load the model with. For Unsloth dynamic 4-bit, "
+                             "keep bnb-4bit and pass a *-unsloth-bnb-4bit checkpoint as --model")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile")
+    parser.add_argument("--batch-size", type=int, default=Config.BATCH_SIZE, help="Images per generate call")
 
     args = parser.parse_args()
 
     if not args.image and not args.folder:
         parser.error("Please specify either --image or --folder")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    try:
+        _check_quant_mode(args.quant)
+    except ValueError as e:
+        parser.error(str(e))
 
-    analyzer = ImageAnalyzer(model_name=args.model)
+    analyzer = ImageAnalyzer(model_name=args.model, quant_mode=args.quant, compile_model=args.compile,
+                             batch_size=1 if args.image else args.batch_size)
 
     if args.image:
         logging.info("Analyzing single image: %s", args.image)
         results = [analyzer.analyze_image(args.image)]
     else:
         logging.info("Analyzing folder: %s", args.folder)
-        results = analyzer.analyze_folder(args.folder)
+        results = analyzer.analyze_folder(args.folder, batch_size=args.batch_size)
 
     log_results(results)
 
@@ -1,9 +1,10 @@
-import json
+import os
+import hashlib
 import logging
-import difflib
 import numpy as np
+import orjson
+import torch
 from pathlib import Path
-from sklearn.metrics.pairwise import cosine_similarity
 from sentence_transformers import SentenceTransformer
 import Levenshtein
 
@@ -12,13 +13,21 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s"
 )
 
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_BATCH_SIZE = 64
+# Short label strings: a much larger batch still fits easily on a GPU and keeps it busy.
+EMBEDDING_BATCH_SIZE_GPU = 256
+
+EMBEDDING_CACHE_DIR = Path(".cache")
+
+_MODEL = None
 
 
 def normalized_edit_similarity(s1: str, s2: str) -> float:
     """
-    Compute normalized edit similarity using difflib.
+    Compute normalized edit similarity (2 * matches / total length) using Levenshtein.
     """
-    return difflib.SequenceMatcher(None, s1, s2).ratio()
+    return Levenshtein.ratio(s1, s2)
 
 
 def levenshtein_distance(s1: str, s2: str) -> int:
@@ -28,129 +37,279 @@ def levenshtein_distance(s1: str, s2: str) -> int:
     return Levenshtein.distance(s1, s2)
 
 
-def evaluate_example(ground_truth: dict, prediction: dict) -> dict:
+def _build_report(ground_truth: dict, prediction: dict, mae: int, wm_acc: int, text_sim: float,
+                  lev_dist: int, cos_sim: float, obj_acc: int, style_acc: int) -> dict:
     """
-    Compare a single prediction to ground truth and compute evaluation metrics.
+    Assemble the per-example report from already computed metric values.
     """
-    report = {}
-    model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+    return {
+        "watermarks": {
+            "true": ground_truth["watermarks"],
+            "pred": prediction["watermarks"],
+            "mae": mae,
+            "accuracy": wm_acc
+        },
+        "text": {
+            "true": ground_truth["text"],
+            "pred": prediction["text"],
+            "normalized_similarity": text_sim,
+            "levenshtein_distance": lev_dist
+        },
+        "main_object": {
+            "true": ground_truth["main object"],
+            "pred": prediction["main_object"],
+            "cosine_similarity": float(cos_sim),
+            "accuracy": obj_acc
+        },
+        "style": {
+            "true": ground_truth["style"],
+            "pred": prediction["style"],
+            "accuracy": style_acc
+        }
+    }
+
 
-    # Watermarks
+def evaluate_example(ground_truth: dict, prediction: dict, cos_sim: float) -> dict:
+    """
+    Compare a single prediction to ground truth and compute evaluation metrics.
+    cos_sim is the precomputed main-object embedding similarity.
+    """
     true_wm = ground_truth["watermarks"]
     pred_wm = prediction["watermarks"]
-    mae = abs(true_wm - pred_wm)
-    wm_acc = int(true_wm == pred_wm)
-    report["watermarks"] = {
-        "true": true_wm,
-        "pred": pred_wm,
-        "mae": mae,
-        "accuracy": wm_acc
-    }
-
-    # Text
     true_text = ground_truth["text"]
     pred_text = prediction["text"]
-    sim = normalized_edit_similarity(true_text, pred_text)
-    lev_dist = levenshtein_distance(true_text, pred_text)
-    report["text"] = {
-        "true": true_text,
-        "pred": pred_text,
-        "normalized_similarity": sim,
-        "levenshtein_distance": lev_dist
-    }
 
-    # Main object
-    true_obj = ground_truth["main object"]
-    pred_obj = prediction["main_object"]
-    emb_true = model.encode([true_obj])
-    emb_pred = model.encode([pred_obj])
-    cos_sim = cosine_similarity(emb_true, emb_pred)[0][0]
-    obj_acc = int(true_obj.lower() == pred_obj.lower())
-    report["main_object"] = {
-        "true": true_obj,
-        "pred": pred_obj,
-        "cosine_similarity": float(cos_sim),
-        "accuracy": obj_acc
-    }
+    return _build_report(
+        ground_truth, prediction,
+        mae=abs(true_wm - pred_wm),
+        wm_acc=int(true_wm == pred_wm),
+        text_sim=normalized_edit_similarity(true_text, pred_text),
+        lev_dist=levenshtein_distance(true_text, pred_text),
+        cos_sim=cos_sim,
+        obj_acc=int(ground_truth["main object"].lower() == prediction["main_object"].lower()),
+        style_acc=int(ground_truth["style"].lower() == prediction["style"].lower())
+    )
 
-    # Style
-    true_style = ground_truth["style"]
-    pred_style = prediction["style"]
-    style_acc = int(true_style.lower() == pred_style.lower())
-    report["style"] = {
-        "true": true_style,
-        "pred": pred_style,
-        "accuracy": style_acc
-    }
 
-    return report
+def _get_model() -> SentenceTransformer:
+    """
+    Load the sentence embedding model once per process (FP16 on GPU when available).
+    """
+    global _MODEL
+    if _MODEL is None:
+        if torch.cuda.is_available():
+            _MODEL = SentenceTransformer(EMBEDDING_MODEL, device="cuda").half()
+        else:
+            _MODEL = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+        _MODEL.eval()
+    return _MODEL
 
 
-def evaluate_dataset(ground_truths: list, predictions: list) -> dict:
+def _embedding_cache_path(model: SentenceTransformer) -> Path:
     """
-    Evaluate predictions for an entire dataset and compute aggregate metrics.
+    Cache file for label embeddings, keyed by the loaded model's checkpoint,
+    embedding dimension and precision.
     """
-    per_example = []
-    total_mae, text_lev, obj_sim, style_acc = [], [], [], []
+    name = model[0].auto_model.config._name_or_path
+    dim = model.get_sentence_embedding_dimension()
+    precision = str(next(model.parameters()).dtype).replace("torch.", "")
+    key = hashlib.sha1(f"{name}:{dim}:{precision}".encode()).hexdigest()[:16]
+    return EMBEDDING_CACHE_DIR / f"label_emb_{key}.npz"
+
 
-    for gt, pred in zip(ground_truths, predictions):
-        report = evaluate_example(gt, pred)
-        per_example.append(report)
+def _load_embedding_cache(path: Path) -> dict:
+    """
+    Load the label -> embedding cache, or an empty one if it does not exist.
+    """
+    if not path.exists():
+        return {}
+    with np.load(path) as data:
+        return dict(zip(data["labels"].tolist(), data["embeddings"]))
 
-        total_mae.append(report["watermarks"]["mae"])
-        text_lev.append(report["text"]["levenshtein_distance"])
-        obj_sim.append(report["main_object"]["cosine_similarity"])
-        style_acc.append(report["style"]["accuracy"])
+
+def _save_embedding_cache(path: Path, cache: dict):
+    """
+    Write the label -> embedding cache atomically.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.stem + ".tmp.npz")
+    np.savez(tmp_path, labels=np.array(list(cache)), embeddings=np.stack(list(cache.values())))
+    os.replace(tmp_path, path)
+
+
+def main_object_similarities(ground_truths: list, predictions: list,
+                             model: SentenceTransformer = None, use_cache: bool = True) -> np.ndarray:
+    """
+    Embed all main-object strings in batched forward passes and return the
+    per-example cosine similarity between ground truth and prediction.
+    With use_cache, label embeddings are persisted under EMBEDDING_CACHE_DIR
+    and only labels not seen in earlier runs are encoded.
+    """
+    if not ground_truths:
+        return np.zeros(0, dtype=np.float32)
+
+    true_objs = [gt["main object"] for gt in ground_truths]
+    pred_objs = [pred["main_object"] for pred in predictions]
+
+    # The encoder is uncased, so labels equal up to case have identical
+    # embeddings: their similarity is 1.0 and they need no encoding at all.
+    sims = np.ones(len(true_objs), dtype=np.float32)
+    differing = [i for i, (t, p) in enumerate(zip(true_objs, pred_objs)) if t.lower() != p.lower()]
+    if not differing:
+        return sims
+    true_objs = [true_objs[i] for i in differing]
+    pred_objs = [pred_objs[i] for i in differing]
+
+    model = model or _get_model()
+    # Labels repeat a lot ("Woman", "painting", ...), so each distinct string is embedded once.
+    unique = list(dict.fromkeys(true_objs + pred_objs))
+
+    cache_path = _embedding_cache_path(model) if use_cache else None
+    cache = _load_embedding_cache(cache_path) if use_cache else {}
+    missing = [obj for obj in unique if obj not in cache]
+    if missing:
+        batch_size = EMBEDDING_BATCH_SIZE_GPU if model.device.type == "cuda" else EMBEDDING_BATCH_SIZE
+        with torch.inference_mode():
+            emb = model.encode(missing, batch_size=batch_size,
+                               convert_to_numpy=True, normalize_embeddings=True)
+        if model.device.type == "cuda":
+            # Embeddings are already on the host; hand the activation blocks back to the driver.
+            torch.cuda.empty_cache()
+        # Accumulate in float32: FP16 embeddings come back as float16 arrays.
+        cache.update(zip(missing, emb.astype(np.float32)))
+        if use_cache:
+            _save_embedding_cache(cache_path, cache)
+    logging.info("Main-object labels: %d pairs differ, %d distinct labels, %d encoded",
+                 len(differing), len(unique), len(missing))
+
+    emb_true = np.stack([cache[obj] for obj in true_objs])
+    emb_pred = np.stack([cache[obj] for obj in pred_objs])
+    sims[differing] = np.einsum("ij,ij->i", emb_true, emb_pred)
+    return sims
+
+
+def evaluate_dataset(ground_truths: list, predictions: list, model: SentenceTransformer = None,
+                     with_examples: bool = True) -> dict:
+    """
+    Evaluate predictions for an entire dataset and compute aggregate metrics.
+    Metrics are kept as one NumPy column each; the nested per-example reports
+    are only materialized when with_examples is set.
+    """
+    n = min(len(ground_truths), len(predictions))
+    ground_truths, predictions = ground_truths[:n], predictions[:n]
+    if not n:
+        summary = dict.fromkeys(("watermarks_MAE", "text_levenshtein_distance",
+                                 "main_object_cosine_similarity", "style_accuracy"))
+        return {"per_example": [], "summary": summary} if with_examples else {"summary": summary}
+
+    # Column-wise metrics: one NumPy op per field instead of one Python op per example.
+    wm_true = np.fromiter((gt["watermarks"] for gt in ground_truths), dtype=np.int32, count=n)
+    wm_pred = np.fromiter((pred["watermarks"] for pred in predictions), dtype=np.int32, count=n)
+    maes = np.abs(wm_true - wm_pred)
+    wm_acc = (wm_true == wm_pred).astype(np.int8)
+
+    obj_acc = (np.char.lower([gt["main object"] for gt in ground_truths])
+               == np.char.lower([pred["main_object"] for pred in predictions])).astype(np.int8)
+    style_acc = (np.char.lower([gt["style"] for gt in ground_truths])
+                 == np.char.lower([pred["style"] for pred in predictions])).astype(np.int8)
+
+    text_sims = np.fromiter((normalized_edit_similarity(gt["text"], pred["text"])
+                             for gt, pred in zip(ground_truths, predictions)), dtype=np.float64, count=n)
+    text_levs = np.fromiter((levenshtein_distance(gt["text"], pred["text"])
+                             for gt, pred in zip(ground_truths, predictions)), dtype=np.int32, count=n)
+
+    cos_sims = main_object_similarities(ground_truths, predictions, model)
+
+    mae = float(maes.mean())
+    lev = float(text_levs.mean())
+    obj_sim = float(cos_sims.astype(np.float64).mean())
+    style = float(style_acc.mean())
 
     summary = {
-        "watermarks_MAE": float(np.mean(total_mae)) if total_mae else None,
-        "text_levenshtein_distance": float(np.mean(text_lev)) if text_lev else None,
-        "main_object_cosine_similarity": float(np.mean(obj_sim)) if obj_sim else None,
-        "style_accuracy": float(np.mean(style_acc)) if style_acc else None
+        "watermarks_MAE": mae,
+        "text_levenshtein_distance": lev,
+        "main_object_cosine_similarity": obj_sim,
+        "style_accuracy": style
     }
 
+    if not with_examples:
+        return {"summary": summary}
+
+    per_example = [
+        _build_report(gt, pred, *row)
+        for gt, pred, row in zip(ground_truths, predictions, zip(
+            maes.tolist(), wm_acc.tolist(), text_sims.tolist(), text_levs.tolist(),
+            cos_sims.tolist(), obj_acc.tolist(), style_acc.tolist()
+        ))
+    ]
     return {"per_example": per_example, "summary": summary}
 
 
 def load_ground_truths(json_path: Path) -> list:
     """
-    Load ground truth dataset from JSON and extract assistant annotations.
+    Load ground truth dataset from JSONL and extract assistant annotations,
+    one line at a time so only the extracted annotations are kept in memory.
     """
-    with open(json_path, "r", encoding="utf-8") as f:
-        test_data = json.load(f)
-
     ground_truths = []
-    for ex in test_data:
-        image_path = ex["messages"][0]["content"][0]["image"]
-        assistant_text = ex["messages"][1]["content"][0]["text"]
-        gt = json.loads(assistant_text)
-
-        required_fields = ["watermarks", "text", "main object", "style"]
-        missing_fields = [fld for fld in required_fields if fld not in gt]
-        if missing_fields:
-            raise ValueError(f"Missing fields {missing_fields} in {image_path}")
-
-        gt["image"] = image_path
-        ground_truths.append(gt)
+    with open(json_path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            ex = orjson.loads(line)
+            image_path = ex["messages"][0]["content"][0]["image"]
+            assistant_text = ex["messages"][1]["content"][0]["text"]
+            gt = orjson.loads(assistant_text)
+
+            required_fields = ["watermarks", "text", "main object", "style"]
+            missing_fields = [fld for fld in required_fields if fld not in gt]
+            if missing_fields:
+                raise ValueError(f"Missing fields {missing_fields} in {image_path}")
+
+            gt["image"] = image_path
+            ground_truths.append(gt)
     return ground_truths
 
 
+def save_results(results: dict, output_path: Path):
+    """
+    Write evaluation results as JSON, serializing one per-example record at a
+    time instead of building the whole document in memory first.
+    """
+    option = orjson.OPT_SERIALIZE_NUMPY
+    with open(output_path, "wb") as f:
+        f.write(b'{\n  "per_example": [')
+        for i, report in enumerate(results.get("per_example", [])):
+            f.write(b",\n    " if i else b"\n    ")
+            f.write(orjson.dumps(report, option=option))
+        f.write(b'\n  ],\n  "summary": ')
+        f.write(orjson.dumps(results["summary"], option=option))
+        f.write(b"\n}\n")
+
+
+def align_by_image(ground_truths: list, predictions: list) -> tuple:
+    """
+    Pair each prediction with the ground truth for the same image, in prediction order.
+    Predictions without a ground truth are dropped.
+    """
+    gt_by_image = {g["image"]: g for g in ground_truths}
+    pairs = [(gt, pred) for pred in predictions
+             if (gt := gt_by_image.get(pred["image"])) is not None]
+    if not pairs:
+        return [], []
+    gt_sorted, pred_sorted = map(list, zip(*pairs))
+    return gt_sorted, pred_sorted
+
+
 def main():
-    ground_truths = load_ground_truths(Path("qwen_dataset/test.json"))
-    with open("lora_test_output.json", "r", encoding="utf-8") as f:
-        predictions = json.load(f)
+    ground_truths = load_ground_truths(Path("qwen_dataset/test.jsonl"))
+    with open("lora_test_output.json", "rb") as f:
+        predictions = orjson.loads(f.read())
 
-    gt_dict = {g["image"]: g for g in ground_truths}
-    pred_sorted, gt_sorted = [], []
-    for pred in predictions:
-        if pred["image"] in gt_dict:
-            pred_sorted.append(pred)
-            gt_sorted.append(gt_dict[pred["image"]])
+    gt_sorted, pred_sorted = align_by_image(ground_truths, predictions)
 
     results = evaluate_dataset(gt_sorted, pred_sorted)
 
-    with open("lora_test_results.json", "w", encoding="utf-8") as f:
-        json.dump(results, f, indent=2, ensure_ascii=False)
+    save_results(results, Path("lora_test_results.json"))
 
     logging.info("Evaluation complete. Metrics saved to lora_test_results.json")
 